@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+
+class AttachmentSpool:
+    """
+    Spools large attachment bodies to anonymous temporary files, so they
+    are streamed from the onward host to disk and sent to the client
+    from there rather than being held in memory. directory, if given,
+    must be absolute as the daemon changes directory to /
+    """
+    PREFIX = "couchproxy-spool-"
+    
+    def __init__(self, directory = None, threshold = 1024 * 1024,
+                       chunk_size = 64 * 1024):
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.owns_directory = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="couchproxy-")
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.clear(directory)
+        self.directory = directory
+    
+    def clear(self, directory):
+        """
+        Removes spool files left in directory by an earlier run
+        """
+        for name in os.listdir(directory):
+            if name.startswith(AttachmentSpool.PREFIX):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except OSError:
+                    pass
+    
+    def is_attachment(self, path):
+        """
+        Returns True if path names a document attachment. Only these are
+        streamed, so other requests keep the persistent onward client
+        """
+        parts = path.split('?', 1)[0].strip('/').split('/')
+        if len(parts) > 3 and parts[1] == '_design':
+            # Design document attachments, but not views, shows etc.
+            return not parts[0].startswith('_') and not parts[3].startswith('_')
+        return len(parts) > 2 and \
+               not [p for p in parts[:3] if p.startswith('_')]
+    
+    def close(self):
+        """
+        Removes the spool directory, if it was created by this spool
+        """
+        if self.owns_directory:
+            shutil.rmtree(self.directory, True)
+    
+    def spool(self, head, response, digest = None):
+        """
+        Writes head followed by the rest of response to a new temporary
+        file, updating digest if given. Returns the file, positioned at
+        the start, and its size
+        """
+        f = tempfile.TemporaryFile(prefix=AttachmentSpool.PREFIX,
+                                   dir=self.directory)
+        try:
+            size = 0
+            data = head
+            while data:
+                f.write(data)
+                if digest:
+                    digest.update(data)
+                size += len(data)
+                data = response.read(self.chunk_size)
+            f.flush()
+            f.seek(0)
+        except:
+            f.close()
+            raise
+        return f, size
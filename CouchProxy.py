@@ -7,9 +7,15 @@ import logging
 from optparse import OptionParser
 import time
 import sys
+import select
+import os
+from signal import signal, SIGTERM
 from AffinityManager import AffinityManager
+from AttachmentSpool import AttachmentSpool
+from TrafficCapture import TrafficCapture
 from CouchProxyRequest import CouchProxyRequest
 from CouchProxyHandler import CouchProxyHandler
+from UnixHTTPServer import UnixHTTPServer
 
 class CouchProxy(Daemon):
     """
@@ -19,7 +25,12 @@ class CouchProxy(Daemon):
     def __init__(self, local_host = "localhost", local_port = 8080,
                        remote_host = "http://localhost:5984",
                        key_file = None, cert_file = None, logger=None,
-                       pid_file = "/tmp/couchproxy.pid"):
+                       pid_file = "/tmp/couchproxy.pid",
+                       spool_threshold = 0, spool_dir = None,
+                       unix_socket = None,
+                       unix_mode = 0660, unix_only = False,
+                       capture_file = None, capture_rate = 1.0,
+                       capture_body = 64 * 1024):
         # Construction business
         Daemon.__init__(self, pid_file)
         self.logger = logger
@@ -31,27 +42,85 @@ class CouchProxy(Daemon):
                                 key_file=key_file, cert_file=cert_file)
         self.handler.logger = self.logger
         
+        # Large responses are spooled to disk, if enabled. The spool is
+        # created in run(), after the daemon has changed directory
+        self.handler.attachment_spool = None
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        if spool_dir:
+            self.spool_dir = os.path.abspath(spool_dir)
+        
+        # Record sampled requests for replay, if enabled
+        self.handler.capture = None
+        if capture_file:
+            self.handler.capture = TrafficCapture(capture_file,
+                                rate=capture_rate, body_sample=capture_body)
+        
         # Configure the server
         self.server_address = (local_host, local_port)
+        self.unix_socket = unix_socket
+        if unix_socket:
+            # The daemon changes directory to / before binding
+            self.unix_socket = os.path.abspath(unix_socket)
+        self.unix_mode = unix_mode
+        self.unix_only = unix_only
         
     def run(self):
         """
         Starts the proxy
         """
-        # Instantiate the server
-        self.httpd = BaseHTTPServer.HTTPServer(self.server_address, self.handler)
+        # Stop between requests when terminated, so the cleanup below runs
+        self.stopping = False
+        signal(SIGTERM, self.stop_serving)
+        
+        # Spool large responses to disk, if enabled
+        if self.spool_threshold > 0:
+            self.handler.attachment_spool = AttachmentSpool(self.spool_dir,
+                                threshold=self.spool_threshold)
         
-        # Add the proxy session affinity manager
-        self.httpd.affinity = AffinityManager(self.logger)
+        # Add the proxy session affinity manager, shared by all listeners
+        affinity = AffinityManager(self.logger)
         
-        # Log the initialisation
-        self.logger.log_info("CouchProxy", "CouchProxy initialised on %s:%s",
-                            self.server_address[0], self.server_address[1])
+        # Instantiate the servers
+        servers = []
+        if self.unix_socket:
+            self.unix_httpd = UnixHTTPServer(self.unix_socket, self.handler,
+                                             self.unix_mode)
+            self.unix_httpd.affinity = affinity
+            servers.append(self.unix_httpd)
+            self.logger.log_info("CouchProxy", "CouchProxy initialised on %s",
+                                self.unix_socket)
+        if not self.unix_only:
+            self.httpd = BaseHTTPServer.HTTPServer(self.server_address, self.handler)
+            self.httpd.affinity = affinity
+            servers.append(self.httpd)
+            self.logger.log_info("CouchProxy", "CouchProxy initialised on %s:%s",
+                                self.server_address[0], self.server_address[1])
         self.logger.log_info("CouchProxy", "Forwarding to %s",
                             self.handler.remote_address)
         
-        # Start it up!
-        self.httpd.serve_forever()
+        # Start it up! Listeners share one thread, as the onward
+        # client is not safe to use concurrently
+        try:
+            while not self.stopping:
+                try:
+                    ready = select.select(servers, [], [], 0.5)[0]
+                except select.error:
+                    # Interrupted by a signal
+                    continue
+                for server in ready:
+                    server._handle_request_noblock()
+        finally:
+            for server in servers:
+                server.server_close()
+            if self.handler.attachment_spool:
+                self.handler.attachment_spool.close()
+    
+    def stop_serving(self, signum, frame):
+        """
+        Asks run() to stop once the current request has been handled
+        """
+        self.stopping = True
 
 def check_server_url(srvurl):
     """
@@ -79,10 +148,35 @@ def parse_args():
         help="Desired location of log. If not specified, no logging (daemon), or console (not daemon)")
     parser.add_option("-d", "--pidfile", dest="pid_file", default="/tmp/couchproxy.pid",
         help="Desired location of deamon pid file. Defaults to /tmp/couchproxy.pid")
+    parser.add_option("-t", "--spoolthreshold", dest="spool_threshold", type="int",
+        default=0, help="GET responses of at least this many bytes are streamed to disk and served from there. Defaults to 0 (disabled)")
+    parser.add_option("-s", "--spooldir", dest="spool_dir", default=None,
+        help="Directory for spooled responses. Defaults to a new temporary directory")
+    parser.add_option("-u", "--unixsocket", dest="unix_socket", default=None,
+        help="Also listen on a Unix domain socket at this path")
+    parser.add_option("-n", "--unixmode", dest="unix_mode", default="0660",
+        help="Octal permissions for the Unix domain socket. Defaults to 0660")
+    parser.add_option("-U", "--unixonly", dest="unix_only", default=False,
+        action="store_true", help="Only listen on the Unix domain socket, not TCP")
+    parser.add_option("-C", "--capturefile", dest="capture_file", default=None,
+        help="Record proxied requests as JSON lines to this file, for CouchProxyReplay")
+    parser.add_option("-R", "--capturerate", dest="capture_rate", type="float",
+        default=1.0, help="Fraction of requests to record. Defaults to 1.0")
+    parser.add_option("-B", "--capturebody", dest="capture_body", type="int",
+        default=64 * 1024, help="Bytes of each request body to record. Requests with longer bodies are skipped by CouchProxyReplay unless --padbodies is given. Defaults to 65536")
     parser.add_option("-v", "--verbose", dest="verbose", default=False,
         action="store_true", help="Turns on verbose logging")
         
-    return parser.parse_args()
+    (options, args) = parser.parse_args()
+    if options.unix_only and not options.unix_socket:
+        parser.error("--unixonly requires --unixsocket")
+    try:
+        options.unix_mode = int(options.unix_mode, 8)
+    except ValueError:
+        parser.error("--unixmode must be octal permissions, e.g. 0660")
+    if options.unix_mode & ~0777:
+        parser.error("--unixmode must be octal permissions, e.g. 0660")
+    return (options, args)
 
 class DateTimeFormatter:
     """
@@ -148,6 +242,14 @@ if __name__ == "__main__":
     daemon = CouchProxy(local_host = options.local_host, local_port = options.local_port,
                         remote_host = options.remote_host, pid_file = options.pid_file,
                         key_file = options.key_file, cert_file = options.cert_file,
+                        spool_threshold = options.spool_threshold,
+                        spool_dir = options.spool_dir,
+                        unix_socket = options.unix_socket,
+                        unix_mode = options.unix_mode,
+                        unix_only = options.unix_only,
+                        capture_file = options.capture_file,
+                        capture_rate = options.capture_rate,
+                        capture_body = options.capture_body,
                         logger=logger)
     
     if len(args) == 1:
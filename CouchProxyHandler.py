@@ -1,4 +1,27 @@
 import BaseHTTPServer
+import re
+import socket
+import struct
+import sys
+import time
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+try:
+    from os import sendfile
+except ImportError:
+    # Python 2 needs the optional pysendfile package
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+# Peer credentials of Unix domain socket clients. Python 2 does not
+# define SO_PEERCRED, so fall back to the Linux value on Linux only
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', None)
+if SO_PEERCRED is None and sys.platform.startswith('linux'):
+    SO_PEERCRED = 17
 
 class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """
@@ -11,6 +34,17 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                    "Content-Type", "User-Agent", "Content-Length",
                    "X-Couch-Full-Commit", "Cookie", "Set-Cookie")
     
+    # Large GET bodies are streamed to disk when this is set
+    attachment_spool = None
+    
+    # Sampled requests are recorded here when this is set
+    capture = None
+    
+    RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+    
+    # Identifies a client connecting over a Unix domain socket
+    CLIENT_HEADER = "X-CouchProxy-Client"
+    
     def send_response(self, code, message=None):
         """Send the response header and log the response code.
 
@@ -30,6 +64,53 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.send_header('Server', self.version_string())
         self.send_header('Date', self.date_time_string())
     
+    def client_key(self):
+        """
+        Returns the name of the calling client, used to key affinity
+        sessions. This is the address for TCP clients. Unix domain socket
+        clients are keyed by peer uid and pid where the platform provides
+        credentials. They may instead name themselves with the
+        X-CouchProxy-Client header, which is scoped to the peer uid so
+        one user cannot take over another's session
+        """
+        if self.server.address_family != socket.AF_UNIX:
+            return self.client_address[0]
+        
+        name = None
+        if hasattr(self, 'headers'):
+            name = self.headers.get(CouchProxyHandler.CLIENT_HEADER, None)
+        creds = self.peer_credentials()
+        if creds:
+            pid, uid, gid = creds
+            if name:
+                return "unix:%d:%s" % (uid, name.strip())
+            return "unix:%d:%d" % (uid, pid)
+        if name:
+            return "unix:%s" % name.strip()
+        return "unix"
+    
+    def peer_credentials(self):
+        """
+        Returns the (pid, uid, gid) of a Unix domain socket client, or
+        None if the platform does not provide them
+        """
+        if SO_PEERCRED is None:
+            return None
+        try:
+            creds = self.connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                            struct.calcsize('3i'))
+            return struct.unpack('3i', creds)
+        except (socket.error, struct.error):
+            return None
+    
+    def address_string(self):
+        """
+        Returns the client name for logging
+        """
+        if self.server.address_family != socket.AF_UNIX:
+            return BaseHTTPServer.BaseHTTPRequestHandler.address_string(self)
+        return self.client_key()
+    
     def log_message(self, format, *args):
         """
         Logs a message, appending useful info"
@@ -98,13 +179,111 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         newCookies.append(cookie)
         headers['Cookie'] = "; ".join(newCookies)
     
+    def parse_range(self, size):
+        """
+        Parses a single byte range from the Range request header.
+        Returns None if the whole body should be sent, an (offset, length)
+        tuple for a satisfiable range, or False if it is unsatisfiable
+        """
+        header = self.headers.getheader("Range", None)
+        if not header:
+            return None
+        match = CouchProxyHandler.RANGE_RE.match(header.strip())
+        if not match:
+            # Multiple or malformed ranges - send everything
+            return None
+        start, end = match.groups()
+        if not start and not end:
+            return None
+        if not start:
+            # Suffix range, the last n bytes
+            length = min(int(end), size)
+            if length == 0:
+                return False
+            return (size - length, length)
+        start = int(start)
+        if start >= size:
+            return False
+        if end:
+            end = min(int(end), size - 1)
+            if end < start:
+                return None
+        else:
+            end = size - 1
+        return (start, end - start + 1)
+    
+    def send_file(self, f, offset, length):
+        """
+        Writes length bytes of f, starting at offset, to the client.
+        Uses sendfile where it is available
+        """
+        self.wfile.flush()
+        if sendfile:
+            out = self.connection.fileno()
+            while length > 0:
+                sent = sendfile(out, f.fileno(), offset, length)
+                if sent == 0:
+                    break
+                offset += sent
+                length -= sent
+        else:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, 64 * 1024))
+                if not data:
+                    break
+                self.wfile.write(data)
+                length -= len(data)
+    
+    def send_spooled(self, response, retHeaders, f, size):
+        """
+        Sends a large response body from the open file f rather than
+        memory, honouring a single byte Range from the client
+        """
+        try:
+            # Work out which part of the body to send. A Range only
+            # applies if If-Range, when given, matches the current ETag
+            status = response.status
+            offset, length = 0, size
+            byte_range = None
+            if_range = self.headers.getheader("If-Range", None)
+            if status == 200 and (not if_range or
+                                  if_range.strip() == retHeaders.get('etag', None)):
+                byte_range = self.parse_range(size)
+            if byte_range is False:
+                status = 416
+                length = 0
+                retHeaders['content-range'] = "bytes */%d" % size
+            elif byte_range:
+                status = 206
+                offset, length = byte_range
+                retHeaders['content-range'] = "bytes %d-%d/%d" % \
+                        (offset, offset + length - 1, size)
+            retHeaders['content-length'] = length
+            retHeaders['accept-ranges'] = 'bytes'
+            if retHeaders.has_key('transfer-encoding'):
+                del retHeaders['transfer-encoding']
+            
+            # Send all headers
+            self.send_response(status)
+            for k in retHeaders:
+                self.send_header(k, retHeaders[k])
+                self.log_debug("      %s: %s", k, retHeaders[k])
+            self.end_headers()
+            
+            # Write the response data
+            self.send_file(f, offset, length)
+            self.log_request(status, length)
+        finally:
+            f.close()
+    
     def generic_request(self, method):
         """
         All methods should be treated the same...
         """
         try:
             # Read the request
-            host, port = self.client_address
+            host = self.client_key()
             content_length = int(self.headers.getheader("Content-Length", 0))
             fwdHeaders = self.get_request_headers()
             body = self.rfile.read(content_length)
@@ -117,25 +296,63 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k in fwdHeaders:
                 self.log_debug("    %s: %s", k, fwdHeaders[k])
         
+            # Snapshot the headers for capture before the affinity
+            # cookie is added
+            capture = self.capture
+            sampled = capture and capture.sampled()
+            if sampled:
+                capHeaders = capture.redact(fwdHeaders)
+        
             # Get affinity header if required
             affinity = self.server.affinity.get_session(host, self)
             if affinity:
                 self.add_cookie(fwdHeaders, affinity)
         
-            # Forward on the request
-            result, response = self.client.makeRequest(self.path, method, fwdHeaders, body)
+            # Forward on the request. Attachment bodies which reach the
+            # spool threshold are streamed to disk rather than read into memory
+            spool = self.attachment_spool
+            digest = None
+            f = None
+            start = time.time()
+            if spool and method == 'GET' and spool.is_attachment(self.path):
+                conn, raw, response = self.client.streamRequest(self.path, method, fwdHeaders, body)
+                try:
+                    result = raw.read(spool.threshold)
+                    if len(result) >= spool.threshold:
+                        if sampled:
+                            digest = md5()
+                        f, size = spool.spool(result, raw, digest)
+                        result = None
+                finally:
+                    raw.close()
+                    conn.close()
+            else:
+                result, response = self.client.makeRequest(self.path, method, fwdHeaders, body)
+            
+            # Record the request if it was sampled
+            if sampled:
+                if f is None:
+                    size = len(result)
+                    digest = md5(result)
+                capture.record(start, time.time() - start, method, self.path,
+                               capHeaders, body, response.status, size, digest)
         
             # Start an affinity session if required
             self.server.affinity.start_session(host, response, self)
         
-            # Return the result
-            self.send_response(response.status)
-        
             # Send / log headers
             # TODO: Strip affinity cookie SetCookie header
             self.log_debug("  Response headers:")
             retHeaders = self.get_response_headers(response)
             
+            # Large bodies (attachments) are served from disk
+            if f:
+                self.send_spooled(response, retHeaders, f, size)
+                return
+            
+            # Return the result
+            self.send_response(response.status)
+        
             # Handle a chunked response - the client has unfolded this
             # so we need to add a content-length header
             if retHeaders.has_key('transfer-encoding') and retHeaders['transfer-encoding'] == 'chunked':
@@ -153,7 +370,7 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         
             # All done!
             self.log_request(response.status, len(result))
-        except:
+        except Exception:
             self.send_response(500)
             self.end_headers()
             message = "Error handling request"
@@ -174,7 +391,7 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if self.path == "/ProxyAffinity/Session":
             try:
                 # Queue the session
-                host, port = self.client_address
+                host = self.client_key()
                 self.server.affinity.queue_session(host, self)
                 self.send_response(200)
                 self.end_headers()
@@ -195,7 +412,7 @@ class CouchProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if self.path == "/ProxyAffinity/Session":
             try:
                 # Remove the session
-                host, port = self.client_address
+                host = self.client_key()
                 self.server.affinity.end_session(host, self)
                 self.send_response(200)
                 self.end_headers()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import base64
+import httplib
+import json
+import sys
+import threading
+import time
+import Queue
+from optparse import OptionParser
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+class CouchProxyReplay:
+    """
+    Replays a TrafficCapture file against a CouchProxy instance, and
+    reports throughput, latency percentiles and any responses which
+    differ from those captured. Requests whose body was not captured in
+    full are skipped, unless pad_bodies is set, in which case they are
+    sent padded with spaces but their responses are not compared
+    """
+    # Recomputed by httplib for the body we send
+    SKIP_HEADERS = ("Content-Length",)
+
+    def __init__(self, records, host = "127.0.0.1", port = 8080,
+                       speed = 1.0, concurrency = 1, pad_bodies = False):
+        self.records = records
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.concurrency = concurrency
+        self.pad_bodies = pad_bodies
+        self.queue = Queue.Queue(concurrency * 4)
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.diffs = []
+        self.unverified = 0
+        self.skipped = 0
+
+    def body(self, rec):
+        """
+        Returns the body to send for a record. Where only a sample was
+        captured it is padded with spaces to the original size
+        """
+        body = base64.b64decode(rec.get('b', ''))
+        if rec.get('bp'):
+            body += ' ' * (rec['n'] - len(body))
+        return body
+
+    def compare(self, rec, status, result):
+        """
+        Returns a description of how a response differs from the
+        captured one, or None if it matches
+        """
+        if status != rec['s']:
+            return "status %s, captured %s" % (status, rec['s'])
+        if len(result) != rec['rn']:
+            return "size %s, captured %s" % (len(result), rec['rn'])
+        if md5(result).hexdigest()[:16] != rec['rd']:
+            return "content differs"
+        return None
+
+    def worker(self):
+        """
+        Sends queued requests over a persistent connection
+        """
+        conn = None
+        while True:
+            rec = self.queue.get()
+            if rec is None:
+                break
+            # JSON gives unicode, which httplib cannot join to a byte body
+            headers = dict([(k.encode('utf-8'), v.encode('utf-8'))
+                            for k, v in rec['h'].items()
+                            if k not in CouchProxyReplay.SKIP_HEADERS])
+            start = time.time()
+            try:
+                if conn is None:
+                    conn = httplib.HTTPConnection(self.host, self.port)
+                conn.request(rec['m'].encode('utf-8'), rec['p'].encode('utf-8'),
+                             self.body(rec), headers)
+                response = conn.getresponse()
+                result = response.read()
+                status = response.status
+            except (httplib.HTTPException, IOError):
+                if conn:
+                    conn.close()
+                conn = None
+                self.lock.acquire()
+                try:
+                    self.errors += 1
+                finally:
+                    self.lock.release()
+                continue
+            latency = time.time() - start
+
+            diff = None
+            if not rec.get('bp'):
+                diff = self.compare(rec, status, result)
+            self.lock.acquire()
+            try:
+                self.latencies.append(latency)
+                if rec.get('bp'):
+                    self.unverified += 1
+                elif diff:
+                    self.diffs.append((rec['m'], rec['p'], diff))
+            finally:
+                self.lock.release()
+        if conn:
+            conn.close()
+
+    def run(self):
+        """
+        Dispatches the records, paced by the capture timestamps divided
+        by speed. A speed of 0 sends as fast as possible
+        """
+        threads = []
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        self.started = time.time()
+        first = None
+        for rec in self.records:
+            if rec.get('bp') and not self.pad_bodies:
+                self.skipped += 1
+                continue
+            if self.speed > 0:
+                if first is None:
+                    first = rec['t']
+                delay = self.started + (rec['t'] - first) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.queue.put(rec)
+
+        for t in threads:
+            self.queue.put(None)
+        for t in threads:
+            t.join()
+        self.finished = time.time()
+
+    def percentile(self, latencies, p):
+        """
+        Returns the p'th percentile of a sorted list of latencies
+        """
+        if not latencies:
+            return 0.0
+        i = int(round(p / 100.0 * (len(latencies) - 1)))
+        return latencies[i]
+
+    def report(self, out = sys.stdout, max_diffs = 20):
+        """
+        Writes a summary of the replay
+        """
+        latencies = sorted(self.latencies)
+        elapsed = self.finished - self.started
+        total = len(latencies) + self.errors
+        out.write("Requests:   %d (%d errors)\n" % (total, self.errors))
+        out.write("Elapsed:    %.2fs\n" % elapsed)
+        if elapsed > 0:
+            out.write("Throughput: %.1f req/s\n" % (total / elapsed))
+        out.write("Latency:    p50 %.1fms  p90 %.1fms  p99 %.1fms  max %.1fms\n" %
+                  tuple([self.percentile(latencies, p) * 1000
+                         for p in (50, 90, 99, 100)]))
+        out.write("Skipped:    %d (body not fully captured)\n" % self.skipped)
+        out.write("Unverified: %d (sent with padded body)\n" % self.unverified)
+        if self.skipped or self.unverified:
+            out.write("Warning: write load is not representative, capture "
+                      "with a larger --capturebody\n")
+        out.write("Diffs:      %d\n" % len(self.diffs))
+        for method, path, diff in self.diffs[:max_diffs]:
+            out.write("  %s %s: %s\n" % (method, path, diff))
+
+def read_capture(filename):
+    """
+    Loads the records from a capture file, ordered by start time
+    """
+    records = []
+    f = open(filename)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    finally:
+        f.close()
+    records.sort(key=lambda rec: rec['t'])
+    return records
+
+def parse_args():
+    usage = "usage: %prog [options] capturefile"
+    parser = OptionParser(usage)
+    parser.add_option("-H", "--host", dest="host", default="127.0.0.1",
+        help="CouchProxy host to replay against. Defaults to 127.0.0.1")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8080,
+        help="CouchProxy port to replay against. Defaults to 8080")
+    parser.add_option("-s", "--speed", dest="speed", type="float", default=1.0,
+        help="Replay speed multiplier, 0 for as fast as possible. Defaults to 1")
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int",
+        default=4, help="Number of concurrent connections. Defaults to 4")
+    parser.add_option("-b", "--padbodies", dest="pad_bodies", default=False,
+        action="store_true", help="Send requests whose body was not fully captured, padded with spaces. CouchDB will usually reject these")
+    return parser.parse_args()
+
+# The script entry point
+if __name__ == "__main__":
+    (options, args) = parse_args()
+    if len(args) != 1:
+        print "A single capture file is required"
+        sys.exit(2)
+
+    replay = CouchProxyReplay(read_capture(args[0]),
+                              host = options.host, port = options.port,
+                              speed = options.speed,
+                              concurrency = options.concurrency,
+                              pad_bodies = options.pad_bodies)
+    replay.run()
+    replay.report()
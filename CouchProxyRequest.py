@@ -1,5 +1,7 @@
 import socket
+import httplib
 import httplib2
+import urlparse
 
 class CouchProxyRequest:
     """
@@ -13,6 +15,8 @@ class CouchProxyRequest:
         URL opener depending on whether key / cert is provided
         """
         self.host = host
+        self.cert_file = cert_file
+        self.key_file = key_file
         if cert_file and key_file:
             self.conn = self._getSSLURLOpener(cert_file, key_file)
         else:
@@ -49,6 +53,44 @@ class CouchProxyRequest:
         # Pass back the response
         return result, response
     
+    def streamRequest(self, resource, verb='GET', headers={}, body=""):
+        """
+        Make a request to the remote host without reading the response
+        body. Returns the connection and the unread httplib response,
+        which the caller must close once the body has been read, and
+        the response headers as an httplib2 response
+        """
+        # Form complete URI, keeping any path prefix of the remote host
+        scheme, netloc, path = urlparse.urlparse(self.host)[:3]
+        uri = path.rstrip('/') + resource
+        
+        # Retry once on a socket error or timeout, as makeRequest does
+        for attempt in (1, 2):
+            conn = self._getStreamConnection(scheme, netloc)
+            try:
+                conn.request(verb, uri, body, headers)
+                raw = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if attempt == 2:
+                    raise socket.error, 'Error contacting: %s' % self.host
+                continue
+            if raw.status == 408 and attempt == 1:
+                raw.close()
+                conn.close()
+                continue
+            return conn, raw, httplib2.Response(raw)
+    
+    def _getStreamConnection(self, scheme, netloc):
+        """
+        method getting an httplib connection for streamed requests
+        """
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, key_file = self.key_file,
+                                           cert_file = self.cert_file,
+                                           timeout = 30)
+        return httplib.HTTPConnection(netloc, timeout = 30)
+    
     def _getURLOpener(self):
         """
         method getting an HTTPConnection
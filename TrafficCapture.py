@@ -0,0 +1,63 @@
+import base64
+import json
+import os
+import random
+from threading import Lock
+
+class TrafficCapture:
+    """
+    Records a sample of proxied requests as JSON lines, for replay by
+    CouchProxyReplay. Each record holds the start time (t), upstream
+    duration in seconds (d), method (m), path (p), forwarded headers (h),
+    request body size (n), an optional base64 body sample (b), and the
+    response status (s), size (rn) and digest (rd). Records whose body
+    was not captured in full are marked with bp. Reentrant safe for
+    threading
+    """
+    # Credentials are never written to the capture
+    REDACT_HEADERS = ("Cookie", "Set-Cookie", "Authorization",
+                      "Proxy-Authorization")
+
+    def __init__(self, filename, rate = 1.0, body_sample = 64 * 1024):
+        self.rate = rate
+        self.body_sample = body_sample
+        self.lock = Lock()
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        self.out = os.fdopen(fd, 'a')
+
+    def sampled(self):
+        """
+        Returns True if the current request should be recorded
+        """
+        return self.rate >= 1.0 or random.random() < self.rate
+
+    def redact(self, headers):
+        """
+        Returns a copy of headers without any credentials
+        """
+        return dict([(k, v) for k, v in headers.items()
+                     if k not in TrafficCapture.REDACT_HEADERS])
+
+    def record(self, start, duration, method, path, headers, body,
+               status, size, digest):
+        """
+        Writes a single request record. headers should already be
+        redacted, and digest is an md5 object holding the response body
+        """
+        rec = {'t': round(start, 3), 'd': round(duration, 4),
+               'm': method, 'p': path, 'h': headers, 'n': len(body),
+               's': status, 'rn': size,
+               'rd': digest.hexdigest()[:16]}
+        sample = body[:self.body_sample]
+        if sample:
+            rec['b'] = base64.b64encode(sample)
+        if len(sample) < len(body):
+            rec['bp'] = 1
+        line = json.dumps(rec, separators=(',', ':')) + "\n"
+
+        self.lock.acquire()
+        try:
+            self.out.write(line)
+            self.out.flush()
+        finally:
+            self.lock.release()
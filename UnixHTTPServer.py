@@ -0,0 +1,40 @@
+import os
+import socket
+import stat
+import BaseHTTPServer
+import SocketServer
+
+class UnixHTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    An HTTP server listening on a Unix domain socket rather than TCP.
+    Intended for clients co-located with the proxy
+    """
+    address_family = socket.AF_UNIX
+
+    def __init__(self, path, handler, mode = 0660):
+        self.socket_mode = mode
+        BaseHTTPServer.HTTPServer.__init__(self, path, handler)
+
+    def server_bind(self):
+        """
+        Removes a stale socket file, binds and applies the permissions
+        """
+        path = self.server_address
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError("%s exists and is not a socket" % path)
+            os.unlink(path)
+        SocketServer.TCPServer.server_bind(self)
+        os.chmod(path, self.socket_mode)
+        self.server_name = path
+        self.server_port = 0
+
+    def server_close(self):
+        """
+        Closes the socket and removes the socket file
+        """
+        BaseHTTPServer.HTTPServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass